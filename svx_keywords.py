@@ -26,24 +26,35 @@ along with this program.  If not, see
 
 """
 
-import re, sys
+import bz2, codecs, gzip, re, sys
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
 
 def svx_encoding(p):
-    '''Try to figure out the character encoding that works for a file'''
-    success = False
-    for encoding in ['utf-8', 'iso-8859-1']: # list of options to try
-        with p.open('r', encoding=encoding) as fp:
-            try:
-                fp.readlines() # we don't need to capture the output here
-            except UnicodeDecodeError:
-                pass
-            else: # if we didn't fail, we found something that works
-                success = True
-                break
-    if not success:
-        raise UnicodeDecodeError(f'Couldnt determine the character encoding for {p}')
-    return encoding
+    '''Figure out the character encoding that works for a file, returning the decoded text too'''
+    stat = p.stat() # the modification time and size invalidate the cache
+    return svx_decode(str(p.resolve()), stat.st_mtime_ns, stat.st_size)
+
+decompressors = {'.gz': gzip.decompress, '.bz2': bz2.decompress} # compressed files are read transparently
+
+@lru_cache(maxsize=4096) # bounded, since edited files leave stale entries behind
+def svx_decode(path, mtime_ns, size):
+    '''Read a file once and decode it with the first encoding that works'''
+    p = Path(path)
+    data = p.read_bytes()
+    if p.suffix in decompressors:
+        data = decompressors[p.suffix](data)
+    if data.startswith(codecs.BOM_UTF8): # a byte order mark is not part of the text
+        data = data[len(codecs.BOM_UTF8):]
+    for encoding in ['UTF-8', 'ISO-8859-1']: # list of options to try, named as they are reported
+        try:
+            text = data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+        else: # if we didn't fail, we found something that works
+            return encoding, text
+    raise ValueError(f'Couldnt determine the character encoding for {path}')
 
 # In the following, hook can be a function which accepts the path p
 # and the context, and returns a line of text (typically, a report).
@@ -58,39 +69,51 @@ def svx_open(p, hook=None, context=[]):
     '''open a survex file and reset line counter'''
     if not p.exists():
         raise FileNotFoundError(p)
-    encoding = svx_encoding(p)
-    fp = p.open('r', encoding=encoding)
+    encoding, text = svx_encoding(p) # the file is only read once
+    if '\r' in text: # universal newlines, as for a file opened in text mode
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n') # one C-level call rather than a readline per line
+    if not lines[-1]: # drop the empty string after a final newline
+        lines.pop()
+    fp = iter(lines)
     postscript = hook(p, context) if hook else ''
     line_number = 0
     return fp, line_number, encoding, postscript
 
-def svx_readline(fp, line_number):
-    '''read a line from the survex file and increment line counter'''
-    return fp.readline(), line_number+1
-
-def extract_keyword_arguments(clean, keywords, keyword_char):
-    '''Extract a keyword and arguments from a cleaned up line'''
-    if clean: #and clean[0] == keyword_char: # detect keyword by presence of keyword character
-        clean_list = clean.split() # drop the keyword char and split on white space
-        for keyword in keywords: # identify the keyword from the list of possible ones
-            if clean_list[0].upper() == keyword:
-                keyword = clean_list[0] # the first entry, preserving case
-                arguments = clean_list[1:] # the rest is the argument
-                break # break out of for loop at this point
-        else: # terminal clause in for loop
-            keyword, arguments = '', [] # the default position
-    else: # line did not start with the keyword character
-        keyword, arguments = '', [] # the default position
-    return keyword, keyword.upper(), arguments
+def keyword_pattern(keywords, comment_char):
+    '''Compile a regex which matches any of the keywords as the first word of a
+    line, and captures the arguments up to the comment character (if any)'''
+    alternatives = '|'.join(map(re.escape, sorted(filter(None, keywords), key=len, reverse=True)))
+    if not alternatives: # nothing to match, use an expression that always fails
+        alternatives = '(?!)'
+    if not comment_char: # no comments, so the arguments run to the end of the line
+        return re.compile(f'({alternatives})(?=\\s|$)(.*)', re.IGNORECASE)
+    comment_char = re.escape(comment_char)
+    return re.compile(f'({alternatives})(?=\\s|{comment_char}|$)([^{comment_char}]*)', re.IGNORECASE)
+
+def keyword_initials(keywords):
+    '''The characters (in either case) that a line has to start with to hold a keyword'''
+    return frozenset(c for keyword in keywords if keyword for c in (keyword[0].lower(), keyword[0].upper()))
+
+def extract_keyword_arguments(line, keyword_re, keyword_char):
+    '''Extract a keyword and arguments from a stripped line, ignoring comments'''
+    match = keyword_re.match(line) # the keyword (if any) is the first word
+    if not match: # line did not start with a keyword, which is the common case
+        return '', '', [] # the default position
+    keyword = match.group(1) # preserving case
+    return keyword, keyword.upper(), match.group(2).split() # the rest is the argument
 
 class SvxRecord:
 
-    def __init__(self, p, encoding, line_number, context, line):
+    __slots__ = ('path', 'encoding', 'line', 'context', 'text', 'prefix', 'postscript') # no per-record __dict__
+
+    def __init__(self, p, encoding, line_number, context, line, prefix=None):
         '''Use this for storing results on a line per line basis'''
         self.path = p
-        self.encoding = encoding.upper()
+        self.encoding = encoding # as reported by svx_encoding, shared by all lines in the file
         self.line = line_number
         self.context = context
+        self.prefix = '.'.join(context) if prefix is None else prefix # the context as a dotted string
         self.text = line
         self.postscript = ''
 
@@ -110,7 +133,10 @@ class SvxReader:
         self.p = Path(svx_file) #.with_suffix('.th') # add the suffix if not already present
         self.top_level = self.p
         self.context = [] # keep this as a list
+        self.prefixes = [''] # the corresponding dotted strings, joined incrementally
         self.keywords = set(['INPUT', 'SURVEY', 'ENDSURVEY'])
+        self.keyword_re = keyword_pattern(self.keywords, self.comment_char) # compiled once here
+        self.initials = keyword_initials(self.keywords)
         self.stack = [(None, None, 0, '')] # initialise file stack with a sentinel
         self.fp, self.line_number, self.encoding, self.postscript = svx_open(self.p, hook=self.open_hook)
         self.files_visited = 1
@@ -121,29 +147,41 @@ class SvxReader:
 
     def __next__(self):
         '''Return the next line or stop iteration'''
-        if not self.fp:
-            raise StopIteration
-        self.line, self.line_number = svx_readline(self.fp, self.line_number) # read line and increment the line number counter
-        if not self.line:
-            self.fp.close() # we ran out of lines for the file being currently processed
+        while True: # loop rather than recurse when files run out of lines
+            if not self.fp:
+                raise StopIteration
+            line = next(self.fp, None) # read the next line, or None at the end of the file
+            if line is not None:
+                break
             self.p, self.fp, self.line_number, self.encoding = self.stack.pop() # back to the including file
-            return next(self)
-        self.line = self.line.strip() # remove leading and trailing whitespace then remove comments
-        clean = self.line.split(self.comment_char)[0].strip() if self.comment_char in self.line else self.line
-        keyword, uc_keyword, arguments = extract_keyword_arguments(clean, self.keywords, self.keyword_char) # preserving case
-        if uc_keyword == 'SURVEY' and arguments: # add the survex context (assume lower case)
-            self.context.append(arguments[0].lower())
-        if uc_keyword == 'ENDSURVEY': #and arguments: # remove the most recent survex context
-            self.context.pop()
-        record = SvxRecord(self.p, self.encoding, self.line_number, self.context, self.line) # before push
+        self.line_number += 1
+        self.line = line = line.strip() # keep a local copy, and remove leading and trailing whitespace
+        if line[:1] in self.initials: # a cheap test which rules out most lines, such as survey data
+            keyword, uc_keyword, arguments = extract_keyword_arguments(line, self.keyword_re, self.keyword_char) # preserving case
+            if uc_keyword == 'SURVEY' and arguments: # add the survex context (assume lower case)
+                self.context = self.context + [arguments[0].lower()] # a new list, so earlier records keep theirs
+                self.prefixes.append(f'{self.prefixes[-1]}.{self.context[-1]}' if self.prefixes[-1] else self.context[-1])
+            elif uc_keyword == 'ENDSURVEY': #and arguments: # remove the most recent survex context
+                self.context = self.context.copy() # likewise
+                self.context.pop()
+                self.prefixes.pop()
+        else: # no keyword, so nothing more to dispatch on
+            uc_keyword = ''
+        record = SvxRecord(self.p, self.encoding, self.line_number, self.context, line, self.prefixes[-1]) # before push
         if uc_keyword == 'INPUT': # process an INCLUDE statement
             self.stack.append((self.p, self.fp, self.line_number, self.encoding)) # push onto stack
-            filename = ' '.join(arguments).strip('"').replace('\\', '/') # remove any quotes and replace backslashes
+            filename = arguments[0] if len(arguments) == 1 else ' '.join(arguments) # usually a single argument
+            filename = filename.strip('"').replace('\\', '/') # remove any quotes and replace backslashes
             self.p = Path(self.p.parent, filename) #.with_suffix('.th' )  #the new path (add the suffix if not already present)
             self.fp, self.line_number, self.encoding, record.postscript = svx_open(self.p, hook=self.open_hook, context=self.context) 
             self.files_visited = self.files_visited + 1
         return record
 
+    @staticmethod
+    def clear_cache():
+        '''Forget the files read and decoded so far, to free memory in long-lived sessions'''
+        svx_decode.cache_clear()
+
     def __enter__(self):
         return self
 
@@ -189,10 +227,31 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', help='(optional) output to spreadsheet (.ods, .xlsx)')
     args = parser.parse_args()
 
+    write = sys.stdout.write # cheaper than print for the result lines, which stay block buffered when redirected
+
+    path_strings = {} # file paths as printed, computed once per file rather than once per line
+
+    def path_string(p):
+        '''format a file path for printing, absolute if requested'''
+        if p not in path_strings:
+            path_strings[p] = str(p.absolute()) if args.directories else str(p)
+        return path_strings[p]
+
+    if args.color: # the layout of a result line is chosen once here, rather than for every result
+        def format_line(path, line_number, prefix, text):
+            '''colorized path, line number, (optional) context, and text (which may carry its own colors)'''
+            context = f'{BLUE}{prefix}{CYAN}' if args.context else ''
+            return f'{PURPLE}{path}{CYAN}:{GREEN}{line_number}{CYAN}:{BLUE}{context}{CYAN}:{text}'
+    else:
+        def format_line(path, line_number, prefix, text):
+            '''path, line number, (optional) context, and text'''
+            context = prefix if args.context else ''
+            return f'{path}:{line_number}:{context}:{text}'
+
     if args.list_files:
         def open_hook(p, context):
             '''hook for tracing which files are being visited'''
-            path = str(p.absolute()) if args.directories else str(p)
+            path = path_string(p)
             context = '.'.join(context) if args.context else ''
             entered = '<entered>' # ensure consistency
             if args.color:
@@ -217,17 +276,12 @@ if __name__ == "__main__":
                 if match:
                     no_matches = False
                     match = match.group()
-                    record_text = record.text.expandtabs()
-                    record_path = str(record.path.absolute()) if args.directories else str(record.path)
-                    record_context = '.'.join(record.context)
+                    record_text = record.text.expandtabs() if '\t' in record.text else record.text # avoid a copy if no tabs
                     if args.color:
-                        context = f'{BLUE}{record_context}{CYAN}' if args.context else ''
-                        line = f'{PURPLE}{record_path}{CYAN}:{GREEN}{record.line}{CYAN}:{BLUE}{context}{CYAN}:{NC}{record_text}'
-                        line = line.replace(match, f'{RED}{match}{NC}')
-                    else:
-                        context = record_context if args.context else ''
-                        line = f'{record_path}:{record.line}:{context}:{record_text}'
-                    print(line)
+                        if match: # highlight within the text only, not the path or the color codes
+                            record_text = record_text.replace(match, f'{RED}{match}{NC}')
+                        record_text = f'{NC}{record_text}'
+                    write(format_line(path_string(record.path), record.line, record.prefix, record_text) + '\n')
                 if record.postscript:
                     print(record.postscript)
         if no_matches:
@@ -248,41 +302,49 @@ if __name__ == "__main__":
             to_be_removed = set(args.excluded_keywords.upper().split(','))
             keywords = keywords.difference(to_be_removed)
 
-        count = dict.fromkeys(keywords, 0)
-        records = []
+        keyword_re = keyword_pattern(keywords, comment_char)
+        initials = keyword_initials(keywords)
+        hits = [] # upper-cased keyword of every record found, counted at the end
+        schema = {'path':str, 'encoding':str, 'line':int, 'context':str,
+                  'keyword':str, 'argument':str, 'full':str}
+        columns = {column: [] for column in schema} # results are accumulated column-wise
 
         with SvxReader(args.svx_file, open_hook=open_hook) as svx_reader:
             if svx_reader.postscript: # catch the trace of the initial file open
                 print(svx_reader.postscript)
             for record in svx_reader:
-                clean = record.text.split(comment_char)[0].strip() if comment_char in record.text else record.text
-                keyword, uc_keyword, arguments = extract_keyword_arguments(clean, keywords, keyword_char) # preserving case
+                if record.text[:1] in initials: # rule out most lines cheaply
+                    keyword, uc_keyword, arguments = extract_keyword_arguments(record.text, keyword_re, keyword_char) # preserving case
+                else:
+                    keyword, uc_keyword, arguments = '', '', []
                 if keyword:
-                    record_text = record.text.expandtabs()
-                    record_path = str(record.path.absolute()) if args.directories else str(record.path)
-                    record_context = '.'.join(record.context)
+                    record_text = record.text.expandtabs() if '\t' in record.text else record.text # avoid a copy if no tabs
+                    record_path = path_string(record.path)
+                    record_context = record.prefix
                     if args.output:
                         arguments = ' '.join(arguments)
-                        keyword = keyword if args.no_ignore_case else uc_keyword
-                        records.append((record_path, record.encoding, record.line, record_context,
-                                        keyword, arguments, record_text))
+                        keyword = sys.intern(keyword if args.no_ignore_case else uc_keyword) # few distinct values
+                        columns['path'].append(record_path)
+                        columns['encoding'].append(record.encoding)
+                        columns['line'].append(record.line)
+                        columns['context'].append(record_context)
+                        columns['keyword'].append(keyword)
+                        columns['argument'].append(arguments)
+                        columns['full'].append(record_text)
                     if args.totals or args.summarize or args.output:
-                        count[uc_keyword] = count[uc_keyword] + 1
+                        hits.append(uc_keyword)
                     else:
                         if args.color:
-                            context = f'{BLUE}{record_context}{CYAN}' if args.context else ''
-                            line = f'{PURPLE}{record_path}{CYAN}:{GREEN}{record.line}{CYAN}:{BLUE}{context}{CYAN}:{NC}{record_text}'
-                            line = line.replace(keyword, f'{RED}{keyword}{NC}', 1)
-                            line = line.replace(keyword_char, f'{RED}{keyword_char}{NC}', 1)
-                            line = line.replace(f'{NC}{RED}', f'{RED}') # simplify
-                        else:
-                            context = record_context if args.context else ''
-                            line = f'{record_path}:{record.line}:{context}:{record_text}'
-                        print(line)
+                            n = len(keyword) # the keyword is always at the start of the text
+                            record_text = f'{RED}{record_text[:n]}{NC}{record_text[n:]}'
+                        write(format_line(record_path, record.line, record_context, record_text) + '\n')
                 if record.postscript:
                     print(record.postscript)
 
-        top_level = str(svx_reader.top_level.absolute()) if args.directories else str(svx_reader.top_level)
+        count = dict.fromkeys(keywords, 0) # so that keywords not found are reported too
+        count.update(Counter(hits))
+
+        top_level = path_string(svx_reader.top_level)
         files_visited = f'{svx_reader.files_visited} files visited'
 
         if args.totals:
@@ -304,10 +366,18 @@ if __name__ == "__main__":
 
         if args.output:
 
-            import pandas as pd
-            schema = {'path':str, 'encoding':str, 'line':int, 'context':str,
-                      'keyword':str, 'argument':str, 'full':str}
-            df = pd.DataFrame(records, columns=schema.keys()).astype(schema)
-            df.to_excel(args.output, index=False)
+            rows = len(columns['line'])
+            if args.output.endswith('.xlsx'): # stream the rows out, avoiding pandas and the in-memory cell tree
+                from openpyxl import Workbook
+                wb = Workbook(write_only=True)
+                ws = wb.create_sheet('Sheet1')
+                ws.append(list(schema.keys()))
+                for row in zip(*columns.values()):
+                    ws.append(row)
+                wb.save(args.output)
+            else:
+                import pandas as pd
+                df = pd.DataFrame(columns) # dtypes follow directly from the column lists
+                df.to_excel(args.output, index=False)
             if not args.quiet:
-                print(f'Dataframe ({len(df.columns)} columns, {len(df)} rows) written to {args.output}')
+                print(f'Dataframe ({len(schema)} columns, {rows} rows) written to {args.output}')